@@ -10,8 +10,29 @@ import yaml
 import numpy as np
 from pathlib import Path
 import shutil
+from multiprocessing import Pool
 from tqdm import tqdm
 
+# Use libyaml's C emitter when PyYAML was built with it
+YAML_DUMPER = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+
+# structure.ply header: binary xyz vertices with rgb colors
+PLY_HEADER_FORMAT = (
+    'ply\n'
+    'format binary_little_endian 1.0\n'
+    'element vertex {num_vertices}\n'
+    'property float x\n'
+    'property float y\n'
+    'property float z\n'
+    'property uchar red\n'
+    'property uchar green\n'
+    'property uchar blue\n'
+    'end_header\n'
+)
+
+# 3x3 intrinsic matrix [[fx, 0, cx], [0, fy, cy], [0, 0, 1]], as np.savetxt(fmt='%.6f') wrote it
+INTRINSICS_FORMAT = '%.6f 0.000000 %.6f\n0.000000 %.6f %.6f\n0.000000 0.000000 1.000000\n'
+
 def read_colmap_cameras(cameras_file):
     """Read COLMAP cameras.txt and extract intrinsics"""
     cameras = {}
@@ -25,7 +46,8 @@ def read_colmap_cameras(cameras_file):
             model = parts[1]
             width = int(parts[2])
             height = int(parts[3])
-            params = [float(x) for x in parts[4:]]
+            # Cast all model params in one go (variable count per model)
+            params = np.array(parts[4:], dtype=np.float64)
 
             cameras[camera_id] = {
                 'model': model,
@@ -36,58 +58,121 @@ def read_colmap_cameras(cameras_file):
     return cameras
 
 def read_colmap_images(images_file):
-    """Read COLMAP images.txt and extract poses"""
-    images = {}
+    """
+    Read COLMAP images.txt and extract poses
+
+    Returns:
+        Dict of per-image columns: 'ids' (N,), 'quats' (N, 4) as qw, qx, qy, qz,
+        'trans' (N, 3), 'camera_ids' (N,) and 'names' (N,)
+    """
     with open(images_file, 'r') as f:
-        lines = [l.strip() for l in f if l.strip() and not l.startswith('#')]
+        lines = [l for l in f.read().split('\n') if not l.startswith('#')]
 
     # images.txt has alternating lines: image info, then points
-    for i in range(0, len(lines), 2):
-        parts = lines[i].split()
-        image_id = int(parts[0])
-        # Quaternion: qw, qx, qy, qz
-        qw, qx, qy, qz = float(parts[1]), float(parts[2]), float(parts[3]), float(parts[4])
-        # Translation
-        tx, ty, tz = float(parts[5]), float(parts[6]), float(parts[7])
-        camera_id = int(parts[8])
-        image_name = parts[9]
-
-        images[image_id] = {
-            'name': image_name,
-            'camera_id': camera_id,
-            'quat': [qw, qx, qy, qz],
-            'trans': [tx, ty, tz]
-        }
-
-    return images
+    # (the points line may be empty, so only comments are dropped before slicing)
+    rows = [l.split()[:10] for l in lines[::2] if l.strip()]
+    arr = np.array(rows) if rows else np.empty((0, 10), dtype=str)
+
+    return {
+        'ids': arr[:, 0].astype(np.int64),
+        'quats': arr[:, 1:5].astype(np.float64),
+        'trans': arr[:, 5:8].astype(np.float64),
+        'camera_ids': arr[:, 8].astype(np.int64),
+        'names': arr[:, 9]
+    }
 
 def read_colmap_points3D(points_file):
-    """Read COLMAP points3D.txt"""
-    points = []
-    with open(points_file, 'r') as f:
-        for line in f:
-            line = line.strip()
-            if not line or line.startswith('#'):
-                continue
-            parts = line.split()
-            # X, Y, Z, R, G, B, ERROR, TRACK[]
-            x, y, z = float(parts[1]), float(parts[2]), float(parts[3])
-            r, g, b = int(parts[4]), int(parts[5]), int(parts[6])
-            points.append([x, y, z, r, g, b])
+    """Read COLMAP points3D.txt as an (N, 6) array of X, Y, Z, R, G, B"""
+    # POINT3D_ID, X, Y, Z, R, G, B, ERROR, TRACK[] -- the track is variable length,
+    # so only the fixed leading columns are parsed
+    return np.loadtxt(points_file, comments='#', usecols=range(1, 7), ndmin=2)
+
+def sort_images_by_name(images):
+    """Reorder every per-image column returned by read_colmap_images by image name"""
+    order = np.argsort(images['names'], kind='stable')
+    return {key: column[order] for key, column in images.items()}
+
+def quaternions_to_rotation_matrices(quats):
+    """Convert (N, 4) quaternions [qw, qx, qy, qz] to (N, 3, 3) rotation matrices"""
+    qw, qx, qy, qz = quats.T
+    xx, yy, zz = qx * qx, qy * qy, qz * qz
+    xy, xz, yz = qx * qy, qx * qz, qy * qz
+    wx, wy, wz = qw * qx, qw * qy, qw * qz
+
+    R = np.empty((len(quats), 3, 3))
+    R[:, 0, 0] = 1 - 2 * (yy + zz)
+    R[:, 0, 1] = 2 * (xy - wz)
+    R[:, 0, 2] = 2 * (xz + wy)
+    R[:, 1, 0] = 2 * (xy + wz)
+    R[:, 1, 1] = 1 - 2 * (xx + zz)
+    R[:, 1, 2] = 2 * (yz - wx)
+    R[:, 2, 0] = 2 * (xz - wy)
+    R[:, 2, 1] = 2 * (yz + wx)
+    R[:, 2, 2] = 1 - 2 * (xx + yy)
+
+    return R
+
+def colmap_poses_to_camera_to_world(quats, trans):
+    """
+    Invert COLMAP world-to-camera poses into (N, 4, 4) camera-to-world matrices
 
-    return np.array(points)
+    Args:
+        quats: (N, 4) world-to-camera quaternions [qw, qx, qy, qz]
+        trans: (N, 3) world-to-camera translations
+    """
+    R_w2c = quaternions_to_rotation_matrices(quats)
 
-def quaternion_to_rotation_matrix(q):
-    """Convert quaternion [qw, qx, qy, qz] to 3x3 rotation matrix"""
-    qw, qx, qy, qz = q
+    T = np.zeros((len(quats), 4, 4))
+    T[:, :3, :3] = R_w2c.transpose(0, 2, 1)
+    # t_c2w = -R_w2c^T @ t_w2c
+    T[:, :3, 3] = -np.einsum('nji,nj->ni', R_w2c, trans)
+    T[:, 3, 3] = 1.0
 
-    R = np.array([
-        [1 - 2*qy**2 - 2*qz**2, 2*qx*qy - 2*qz*qw, 2*qx*qz + 2*qy*qw],
-        [2*qx*qy + 2*qz*qw, 1 - 2*qx**2 - 2*qz**2, 2*qy*qz - 2*qx*qw],
-        [2*qx*qz - 2*qy*qw, 2*qy*qz + 2*qx*qw, 1 - 2*qx**2 - 2*qy**2]
-    ])
+    return T
 
-    return R
+def build_image_index(image_dir):
+    """Map file name -> path for every file under image_dir (first match in walk order wins)"""
+    index = {}
+    for root, dirs, files in os.walk(image_dir):
+        for name in files:
+            index.setdefault(name, Path(root) / name)
+    return index
+
+def fast_copy(src, dst):
+    """
+    Copy src to dst without moving the bytes through userspace
+
+    Hardlinks when src and dst share a filesystem, otherwise copies in the kernel
+    with os.copy_file_range (a reflink on XFS/Btrfs), falling back to a regular copy.
+    """
+    # Replace rather than write through an existing dst, which may be a hardlink to src
+    if os.path.lexists(dst):
+        os.remove(dst)
+
+    try:
+        os.link(src, dst)
+        return
+    except OSError:
+        pass
+
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        size = os.fstat(fsrc.fileno()).st_size
+        remaining = size
+        try:
+            while remaining > 0:
+                copied = os.copy_file_range(fsrc.fileno(), fdst.fileno(), remaining)
+                if copied == 0:
+                    break
+                remaining -= copied
+        except (AttributeError, OSError):
+            pass
+        if remaining > 0:
+            # No copy_file_range (non-Linux), unsupported here, or it stopped short:
+            # copy the rest the regular way from where the kernel copy left off
+            fsrc.seek(size - remaining)
+            fdst.seek(size - remaining)
+            shutil.copyfileobj(fsrc, fdst)
+    shutil.copystat(src, dst)
 
 def convert_colmap_to_training_format(sparse_dir, output_dir, copy_images=True):
     """
@@ -116,29 +201,47 @@ def convert_colmap_to_training_format(sparse_dir, output_dir, copy_images=True):
     image_dir.mkdir(exist_ok=True)
     intrinsics_dir.mkdir(exist_ok=True)
 
+    # Index of the image tree, built on the first missed lookup only; images
+    # usually sit directly in image_source_dir and the tree is never walked
+    name_index = None
+
     # Sort images by name (assumes sequential naming)
-    sorted_images = sorted(images.items(), key=lambda x: x[1]['name'])
+    images = sort_images_by_name(images)
+
+    # Convert COLMAP poses to motion format for all frames at once
+    # COLMAP uses world-to-camera transformation
+    # We need camera-to-world for motion.yaml
+    T_c2w = colmap_poses_to_camera_to_world(images['quats'], images['trans'])
+
+    # Format the 3x3 intrinsic matrix once per camera; every view of a camera shares it
+    intrinsics_text = {}
+    for camera_id, cam in cameras.items():
+        if cam['model'] == 'OPENCV':
+            # OPENCV model: fx, fy, cx, cy, k1, k2, p1, p2
+            fx, fy, cx, cy = cam['params'][0], cam['params'][1], cam['params'][2], cam['params'][3]
+        elif cam['model'] == 'PINHOLE':
+            # PINHOLE model: fx, fy, cx, cy
+            fx, fy, cx, cy = cam['params'][0], cam['params'][1], cam['params'][2], cam['params'][3]
+        else:
+            # Default: assume first 4 params are fx, fy, cx, cy
+            fx, fy, cx, cy = cam['params'][0], cam['params'][1], cam['params'][2], cam['params'][3]
 
-    # Prepare motion data (poses)
-    motion_data = {}
+        intrinsics_text[camera_id] = INTRINSICS_FORMAT % (fx, cx, fy, cy)
 
-    for idx, (img_id, img_data) in enumerate(sorted_images):
-        img_name = img_data['name']
-        camera_id = img_data['camera_id']
+    for idx, (img_name, camera_id) in enumerate(zip(images['names'].tolist(), images['camera_ids'].tolist())):
 
         # Copy/link image
         src_image = image_source_dir / img_name
         if not src_image.exists():
             # Try to find in subdirectories
-            for root, dirs, files in os.walk(image_source_dir):
-                if img_name in files:
-                    src_image = Path(root) / img_name
-                    break
+            if name_index is None:
+                name_index = build_image_index(image_source_dir)
+            src_image = name_index.get(img_name, src_image)
 
         if src_image.exists():
             dst_image = image_dir / f'{idx:010d}.png'
             if copy_images:
-                shutil.copy2(src_image, dst_image)
+                fast_copy(src_image, dst_image)
             else:
                 if not dst_image.exists():
                     # Use absolute paths for symlinks
@@ -147,69 +250,63 @@ def convert_colmap_to_training_format(sparse_dir, output_dir, copy_images=True):
             print(f"Warning: Source image not found: {img_name}")
 
         # Write camera intrinsics
-        cam = cameras[camera_id]
         intrinsic_file = intrinsics_dir / f'{idx:010d}.txt'
+        with open(intrinsic_file, 'w') as f:
+            f.write(intrinsics_text[camera_id])
 
-        if cam['model'] == 'OPENCV':
-            # OPENCV model: fx, fy, cx, cy, k1, k2, p1, p2
-            fx, fy, cx, cy = cam['params'][0], cam['params'][1], cam['params'][2], cam['params'][3]
-        elif cam['model'] == 'PINHOLE':
-            # PINHOLE model: fx, fy, cx, cy
-            fx, fy, cx, cy = cam['params'][0], cam['params'][1], cam['params'][2], cam['params'][3]
-        else:
-            # Default: assume first 4 params are fx, fy, cx, cy
-            fx, fy, cx, cy = cam['params'][0], cam['params'][1], cam['params'][2], cam['params'][3]
-
-        # Write 3x3 intrinsic matrix
-        K = np.array([
-            [fx, 0, cx],
-            [0, fy, cy],
-            [0, 0, 1]
-        ])
-
-        np.savetxt(intrinsic_file, K, fmt='%.6f')
+    # Write motion.yaml: 4x4 camera-to-world matrices in frame order, converted
+    # to nested lists in one go
+    motion_data = dict(enumerate(T_c2w.tolist()))
+    motion_file = output_path / 'motion.yaml'
+    with open(motion_file, 'w') as f:
+        f.write(yaml.dump({'motion': motion_data}, Dumper=YAML_DUMPER))
 
-        # Convert COLMAP pose to motion format
-        # COLMAP uses world-to-camera transformation
-        # We need camera-to-world for motion.yaml
-        R_w2c = quaternion_to_rotation_matrix(img_data['quat'])
-        t_w2c = np.array(img_data['trans']).reshape(3, 1)
+    # Write structure.ply (sparse 3D points) as binary PLY in one bulk write
+    vertices = np.empty(len(points3D), dtype=[('x', '<f4'), ('y', '<f4'), ('z', '<f4'),
+                                              ('red', 'u1'), ('green', 'u1'), ('blue', 'u1')])
+    for j, name in enumerate(vertices.dtype.names):
+        vertices[name] = points3D[:, j]
 
-        # Invert to get camera-to-world
-        R_c2w = R_w2c.T
-        t_c2w = -R_c2w @ t_w2c
+    ply_file = output_path / 'structure.ply'
+    with open(ply_file, 'wb') as f:
+        f.write(PLY_HEADER_FORMAT.format(num_vertices=len(points3D)).encode())
+        vertices.tofile(f)
 
-        # Store as 4x4 transformation matrix
-        T = np.eye(4)
-        T[:3, :3] = R_c2w
-        T[:3, 3] = t_c2w.flatten()
+    return len(images['names']), len(points3D)
 
-        motion_data[idx] = T.tolist()
+def find_sparse_dirs(root):
+    """
+    Find all sparse/0 reconstructions under root
 
-    # Write motion.yaml
-    motion_file = output_path / 'motion.yaml'
-    with open(motion_file, 'w') as f:
-        yaml.dump({'motion': motion_data}, f)
+    Walks the tree once and does not descend into sparse/ once a reconstruction
+    is found there; other subdirectories are still searched for nested ones.
+    """
+    sparse_dirs = []
+    for dirpath, dirnames, _ in os.walk(root):
+        if 'sparse' in dirnames and os.path.isdir(os.path.join(dirpath, 'sparse', '0')):
+            sparse_dirs.append(Path(dirpath) / 'sparse' / '0')
+            # Prune only sparse/; sibling folders may hold nested reconstructions
+            dirnames.remove('sparse')
+    return sorted(sparse_dirs)
+
+def convert_task(task):
+    """
+    Pool worker: convert one (sparse_dir, output_seq_dir) pair
 
-    # Write structure.ply (sparse 3D points)
-    ply_file = output_path / 'structure.ply'
-    with open(ply_file, 'w') as f:
-        f.write('ply\n')
-        f.write('format ascii 1.0\n')
-        f.write(f'element vertex {len(points3D)}\n')
-        f.write('property float x\n')
-        f.write('property float y\n')
-        f.write('property float z\n')
-        f.write('property uchar red\n')
-        f.write('property uchar green\n')
-        f.write('property uchar blue\n')
-        f.write('end_header\n')
-
-        for point in points3D:
-            x, y, z, r, g, b = point
-            f.write(f'{x:.6f} {y:.6f} {z:.6f} {int(r)} {int(g)} {int(b)}\n')
-
-    return len(sorted_images), len(points3D)
+    Returns:
+        (task, (num_images, num_points), None) on success, (task, None, error) on failure
+    """
+    sparse_dir, output_seq_dir = task
+    # Only a directory this run creates may be cleaned up on failure
+    existed = os.path.exists(output_seq_dir)
+    try:
+        counts = convert_colmap_to_training_format(sparse_dir, output_seq_dir, copy_images=False)
+        return task, counts, None
+    except Exception as e:
+        # Don't leave a half-written sequence behind, but never delete earlier output
+        if not existed:
+            shutil.rmtree(output_seq_dir, ignore_errors=True)
+        return task, None, str(e)
 
 def main():
     if len(sys.argv) != 3:
@@ -228,7 +325,7 @@ def main():
 
     # Find all sparse/0 directories
     print("Scanning for COLMAP reconstructions...")
-    sparse_dirs = list(dataset_root.rglob('sparse/0'))
+    sparse_dirs = find_sparse_dirs(dataset_root)
 
     if not sparse_dirs:
         print(f"ERROR: No sparse/0 directories found in {dataset_root}")
@@ -237,46 +334,41 @@ def main():
     print(f"Found {len(sparse_dirs)} COLMAP reconstructions")
     print()
 
-    # Convert each one
-    bag_idx = 0
-    seq_idx = 0
+    # Assign output directories up front: bag_X/sequence_Y, 10 sequences per bag
+    tasks = []
+    log_labels = {}  # sparse_dir -> (path relative to dataset root, bag_X/sequence_Y)
+    for i, sparse_dir in enumerate(sparse_dirs):
+        seq_name = f'bag_{i // 10}/sequence_{i % 10}'
+        tasks.append((sparse_dir, output_root / seq_name))
+        log_labels[sparse_dir] = (sparse_dir.relative_to(dataset_root), seq_name)
+
+    # Create all bag_X directories once, before the workers start
+    for bag_idx in range((len(tasks) + 9) // 10):
+        (output_root / f'bag_{bag_idx}').mkdir(exist_ok=True)
+
+    # Convert each one (sequences are independent, so run them in parallel)
     success = 0
     failed = 0
 
     log_file = output_root / 'conversion_log.txt'
+    success_fmt = "✓ %s -> %s (%d images, %d points)\n"
+    failure_fmt = "✗ %s: %s\n"
 
-    with open(log_file, 'w') as log:
+    with open(log_file, 'w') as log, Pool(os.cpu_count()) as pool:
         log.write(f"Conversion started\n")
         log.write(f"Dataset root: {dataset_root}\n")
         log.write(f"Output root: {output_root}\n\n")
 
-        for sparse_dir in tqdm(sparse_dirs, desc="Converting"):
-            try:
-                # Create output directory: bag_X/sequence_Y
-                output_seq_dir = output_root / f'bag_{bag_idx}' / f'sequence_{seq_idx}'
-
-                # Get relative path for logging
-                rel_path = sparse_dir.relative_to(dataset_root)
-
-                # Convert
-                num_images, num_points = convert_colmap_to_training_format(
-                    sparse_dir, output_seq_dir, copy_images=False
-                )
+        results = pool.imap_unordered(convert_task, tasks)
+        for (sparse_dir, _), counts, error in tqdm(results, total=len(tasks), desc="Converting"):
+            rel_path, seq_name = log_labels[sparse_dir]
 
-                log_msg = f"✓ {rel_path} -> bag_{bag_idx}/sequence_{seq_idx} ({num_images} images, {num_points} points)\n"
-                log.write(log_msg)
+            if error is None:
+                log.write(success_fmt % (rel_path, seq_name, *counts))
                 success += 1
-
-                # Increment sequence/bag counter
-                seq_idx += 1
-                if seq_idx >= 10:  # 10 sequences per bag
-                    seq_idx = 0
-                    bag_idx += 1
-
-            except Exception as e:
-                log_msg = f"✗ {rel_path}: {str(e)}\n"
-                log.write(log_msg)
-                print(f"\nError processing {sparse_dir}: {e}")
+            else:
+                log.write(failure_fmt % (rel_path, error))
+                print(f"\nError processing {sparse_dir}: {error}")
                 failed += 1
 
     # Summary
@@ -11,8 +11,30 @@ import numpy as np
 import cv2
 from pathlib import Path
 import shutil
+from multiprocessing import Pool
 from tqdm import tqdm
 
+# Use libyaml's C emitter when PyYAML was built with it
+YAML_DUMPER = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+
+# Baseline (non-optimized, non-progressive) JPEG at OpenCV's default quality
+JPEG_WRITE_PARAMS = [cv2.IMWRITE_JPEG_QUALITY, 95, cv2.IMWRITE_JPEG_OPTIMIZE, 0, cv2.IMWRITE_JPEG_PROGRESSIVE, 0]
+
+# structure.ply header: xyz vertices plus one camera element
+PLY_HEADER_FORMAT = (
+    'ply\nformat binary_little_endian 1.0\n'
+    'comment PCL generated\n'
+    'element vertex {num_vertices}\n'
+    'property float x\nproperty float y\nproperty float z\n'
+    'element camera 1\n'
+    'property float view_px\nproperty float view_py\nproperty float view_pz\n'
+    'property float x_axisx\nproperty float x_axisy\nproperty float x_axisz\n'
+    'property float y_axisx\nproperty float y_axisy\nproperty float y_axisz\n'
+    'property float z_axisx\nproperty float z_axisy\nproperty float z_axisz\n'
+    'end_header\n'
+)
+PLY_DUMMY_CAMERA = np.array([0, 0, 0, 1, 0, 0, 0, 1, 0, 0, 0, 1], dtype='<f4').tobytes()
+
 def read_colmap_cameras(cameras_file):
     cameras = {}
     with open(cameras_file, 'r') as f:
@@ -26,85 +48,62 @@ def read_colmap_cameras(cameras_file):
                 'model': parts[1],
                 'width': int(parts[2]),
                 'height': int(parts[3]),
-                'params': [float(x) for x in parts[4:]]
+                'params': np.array(parts[4:], dtype=np.float64)
             }
     return cameras
 
 def read_colmap_images(images_file):
-    images = {}
     with open(images_file, 'r') as f:
-        lines = [l.strip() for l in f if l.strip() and not l.startswith('#')]
-
-    for i in range(0, len(lines), 2):
-        parts = lines[i].split()
-        image_id = int(parts[0])
-        images[image_id] = {
-            'name': parts[9],
-            'camera_id': int(parts[8]),
-            'quat': [float(parts[j]) for j in range(1, 5)],
-            'trans': [float(parts[j]) for j in range(5, 8)]
-        }
-    return images
+        lines = [l for l in f.read().split('\n') if not l.startswith('#')]
+
+    # Alternating image/points lines; points lines may be empty
+    rows = [l.split()[:10] for l in lines[::2] if l.strip()]
+    arr = np.array(rows) if rows else np.empty((0, 10), dtype=str)
+    return {
+        'ids': arr[:, 0].astype(np.int64),
+        'quats': arr[:, 1:5].astype(np.float64),
+        'trans': arr[:, 5:8].astype(np.float64),
+        'camera_ids': arr[:, 8].astype(np.int64),
+        'names': arr[:, 9]
+    }
 
 def read_colmap_points3D(points_file):
-    points = []
-    with open(points_file, 'r') as f:
-        for line in f:
-            line = line.strip()
-            if not line or line.startswith('#'):
-                continue
-            parts = line.split()
-            points.append([float(parts[1]), float(parts[2]), float(parts[3]),
-                          int(parts[4]), int(parts[5]), int(parts[6])])
-    return np.array(points) if points else np.array([]).reshape(0, 6)
-
-def quaternion_to_rotation_matrix(q):
-    qw, qx, qy, qz = q
-    return np.array([
-        [1 - 2*qy**2 - 2*qz**2, 2*qx*qy - 2*qz*qw, 2*qx*qz + 2*qy*qw],
-        [2*qx*qy + 2*qz*qw, 1 - 2*qx**2 - 2*qz**2, 2*qy*qz - 2*qx*qw],
-        [2*qx*qz - 2*qy*qw, 2*qy*qz + 2*qx*qw, 1 - 2*qx**2 - 2*qy**2]
-    ])
-
-def rotation_matrix_to_quaternion(R):
-    """Convert 3x3 rotation matrix to quaternion [qw, qx, qy, qz]"""
-    trace = np.trace(R)
-    if trace > 0:
-        s = 0.5 / np.sqrt(trace + 1.0)
-        qw = 0.25 / s
-        qx = (R[2,1] - R[1,2]) * s
-        qy = (R[0,2] - R[2,0]) * s
-        qz = (R[1,0] - R[0,1]) * s
-    elif R[0,0] > R[1,1] and R[0,0] > R[2,2]:
-        s = 2.0 * np.sqrt(1.0 + R[0,0] - R[1,1] - R[2,2])
-        qw = (R[2,1] - R[1,2]) / s
-        qx = 0.25 * s
-        qy = (R[0,1] + R[1,0]) / s
-        qz = (R[0,2] + R[2,0]) / s
-    elif R[1,1] > R[2,2]:
-        s = 2.0 * np.sqrt(1.0 + R[1,1] - R[0,0] - R[2,2])
-        qw = (R[0,2] - R[2,0]) / s
-        qx = (R[0,1] + R[1,0]) / s
-        qy = 0.25 * s
-        qz = (R[1,2] + R[2,1]) / s
-    else:
-        s = 2.0 * np.sqrt(1.0 + R[2,2] - R[0,0] - R[1,1])
-        qw = (R[1,0] - R[0,1]) / s
-        qx = (R[0,2] + R[2,0]) / s
-        qy = (R[1,2] + R[2,1]) / s
-        qz = 0.25 * s
-    return [qw, qx, qy, qz]
-
-def find_image(image_dir, image_name):
-    """Search for image in directory tree"""
-    direct = image_dir / image_name
-    if direct.exists():
-        return direct
-
+    # Only the fixed ID, X, Y, Z, R, G, B columns; the track tail is variable length
+    return np.loadtxt(points_file, comments='#', usecols=range(1, 7), ndmin=2)
+
+def sort_images_by_name(images):
+    # Reorder every per-image column by image name (assumes sequential naming)
+    order = np.argsort(images['names'], kind='stable')
+    return {key: column[order] for key, column in images.items()}
+
+def rotate_by_quaternions(quats, vecs):
+    """Rotate (N, 3) vectors by (N, 4) unit quaternions [qw, qx, qy, qz]"""
+    # v' = v + 2w(u x v) + 2u x (u x v), with u the vector part
+    w, u = quats[:, :1], quats[:, 1:]
+    uv = np.cross(u, vecs)
+    return vecs + 2 * (w * uv + np.cross(u, uv))
+
+def build_image_index(image_dir):
+    """Map file name -> path for every file in the directory tree (first match wins)"""
+    index = {}
     for root, _, files in os.walk(image_dir):
-        if image_name in files:
-            return Path(root) / image_name
-    return None
+        for name in files:
+            index.setdefault(name, os.path.join(root, name))
+    return index
+
+def find_image(image_dir, image_name, name_index):
+    """
+    Look for image directly in image_dir, then anywhere in its tree via name_index
+
+    name_index starts out empty and is filled from one walk of the tree on the
+    first miss, so sequences whose images are all found directly are never walked
+    """
+    direct = os.path.join(image_dir, image_name)
+    if os.path.exists(direct):
+        return direct
+    if not name_index:
+        name_index.update(build_image_index(image_dir))
+    return name_index.get(image_name)
 
 def convert_sequence(sparse_dir, output_dir, image_source_dir):
     """Convert one COLMAP sequence to training format"""
@@ -112,6 +111,8 @@ def convert_sequence(sparse_dir, output_dir, image_source_dir):
     output_path = Path(output_dir)
     image_source_path = Path(image_source_dir)
 
+    # Create output structure
+    # Images go directly in sequence directory (not in image_0 subdirectory)
     output_path.mkdir(parents=True, exist_ok=True)
 
     # Read COLMAP data
@@ -119,75 +120,73 @@ def convert_sequence(sparse_dir, output_dir, image_source_dir):
     images = read_colmap_images(sparse_path / 'images.txt')
     points3D = read_colmap_points3D(sparse_path / 'points3D.txt')
 
-    # Create output structure
-    # Images go directly in sequence directory (not in image_0 subdirectory)
-    output_path.mkdir(parents=True, exist_ok=True)
-
-    poses_list = []  # ROS-style pose messages
+    poses = {}  # ROS-style pose messages, keyed 'poses[idx]'
     intrinsics_list = []  # Collect intrinsics for single file
     found = 0
     missing = []
 
-    sorted_imgs = sorted(images.items(), key=lambda x: x[1]['name'])
+    images = sort_images_by_name(images)
+
+    # Index of the image tree, built by find_image on the first missed lookup
+    name_index = {}
 
-    for idx, (img_id, img_data) in enumerate(sorted_imgs):
-        img_name = img_data['name']
+    # Camera-to-world poses for all frames at once: the inverse rotation of a
+    # unit quaternion is its conjugate, so no rotation matrix is needed
+    quats_c2w = images['quats'] * np.array([1.0, -1.0, -1.0, -1.0])
+    t_c2w = -rotate_by_quaternions(quats_c2w, images['trans'])
+    # Plain Python floats for the YAML dump, converted in bulk
+    quats_c2w, t_c2w = quats_c2w.tolist(), t_c2w.tolist()
+
+    frames = zip(images['names'].tolist(), images['camera_ids'].tolist(), quats_c2w, t_c2w)
+    for idx, (img_name, camera_id, (qw, qx, qy, qz), (tx, ty, tz)) in enumerate(frames):
 
         # Find and copy image
-        src = find_image(image_source_path, img_name)
+        src = find_image(image_source_path, img_name, name_index)
         if src:
-            dst = output_path / f'{idx:08d}.jpg'
-            # Read and re-save as jpg if source is png
-            img = cv2.imread(str(src))
-            if img is not None:
-                cv2.imwrite(str(dst), img)
+            dst = os.path.join(output_path, f'{idx:08d}.jpg')
+            if os.path.splitext(src)[1].lower() in ('.jpg', '.jpeg'):
+                # Already JPEG: copy the bytes instead of decoding and re-encoding
+                shutil.copyfile(src, dst)
                 found += 1
             else:
-                missing.append(img_name)
-                continue
+                # Read and re-save as jpg if source is png
+                img = cv2.imread(src)
+                if img is not None:
+                    cv2.imwrite(dst, img, JPEG_WRITE_PARAMS)
+                    found += 1
+                else:
+                    missing.append(img_name)
+                    continue
         else:
             missing.append(img_name)
             continue
 
         # Collect intrinsics
-        cam = cameras[img_data['camera_id']]
+        cam = cameras[camera_id]
         fx, fy, cx, cy = cam['params'][:4]
         intrinsics_list.extend([fx, fy, cx, cy])  # Add to list for single file
 
-        # Compute pose (convert to camera-to-world)
-        R_w2c = quaternion_to_rotation_matrix(img_data['quat'])
-        t_w2c = np.array(img_data['trans']).reshape(3, 1)
-        R_c2w = R_w2c.T
-        t_c2w = -R_c2w @ t_w2c
-
-        # Convert back to quaternion for ROS format
-        quat_c2w = rotation_matrix_to_quaternion(R_c2w)
-
         # Create ROS-style pose message
-        pose = {
-            f'poses[{idx}]': {
-                'position': {
-                    'x': float(t_c2w[0]),
-                    'y': float(t_c2w[1]),
-                    'z': float(t_c2w[2])
-                },
-                'orientation': {
-                    'x': float(quat_c2w[1]),  # qx
-                    'y': float(quat_c2w[2]),  # qy
-                    'z': float(quat_c2w[3]),  # qz
-                    'w': float(quat_c2w[0])   # qw
-                }
+        poses[f'poses[{idx}]'] = {
+            'position': {
+                'x': tx,
+                'y': ty,
+                'z': tz
+            },
+            'orientation': {
+                'x': qx,
+                'y': qy,
+                'z': qz,
+                'w': qw
             }
         }
-        poses_list.append(pose)
 
     if found == 0:
         raise ValueError(f"No images found")
 
     # Write single camera_intrinsics_per_view file (one parameter per line)
     with open(output_path / 'camera_intrinsics_per_view', 'w') as f:
-        for param in intrinsics_list:
-            f.write(f'{param:.6f}\n')
+        f.write(''.join(f'{param:.6f}\n' for param in intrinsics_list))
 
     # Save motion in ROS format
     motion_yaml = {
@@ -196,36 +195,45 @@ def convert_sequence(sparse_dir, output_dir, image_source_dir):
             'stamp': 0.0,
             'frame_id': ''
         },
-        'poses[]': {}
+        'poses[]': poses
     }
 
-    # Merge all pose dictionaries
-    for pose_dict in poses_list:
-        motion_yaml['poses[]'].update(pose_dict)
-
     with open(output_path / 'motion.yaml', 'w') as f:
-        yaml.dump(motion_yaml, f, default_flow_style=False)
-
-    # Save structure (only xyz, no colors)
-    with open(output_path / 'structure.ply', 'w') as f:
-        f.write('ply\nformat ascii 1.0\n')
-        f.write('comment PCL generated\n')
-        f.write(f'element vertex {len(points3D)}\n')
-        f.write('property float x\nproperty float y\nproperty float z\n')
-        f.write('element camera 1\n')
-        f.write('property float view_px\nproperty float view_py\nproperty float view_pz\n')
-        f.write('property float x_axisx\nproperty float x_axisy\nproperty float x_axisz\n')
-        f.write('property float y_axisx\nproperty float y_axisy\nproperty float y_axisz\n')
-        f.write('property float z_axisx\nproperty float z_axisy\nproperty float z_axisz\n')
-        f.write('end_header\n')
+        f.write(yaml.dump(motion_yaml, Dumper=YAML_DUMPER, default_flow_style=False))
+
+    # Save structure (only xyz, no colors) as binary PLY
+    with open(output_path / 'structure.ply', 'wb') as f:
+        f.write(PLY_HEADER_FORMAT.format(num_vertices=len(points3D)).encode())
         # Write points (xyz only)
-        for pt in points3D:
-            f.write(f'{pt[0]:.6f} {pt[1]:.6f} {pt[2]:.6f}\n')
+        points3D[:, :3].astype('<f4').tofile(f)
         # Write dummy camera (use first pose)
-        f.write('0.0 0.0 0.0 1.0 0.0 0.0 0.0 1.0 0.0 0.0 0.0 1.0\n')
+        f.write(PLY_DUMMY_CAMERA)
 
     return found, len(points3D)
 
+def find_sparse_dirs(root):
+    """Find all sparse/0 reconstructions under root, at any depth, without listing sparse/ itself"""
+    sparse_dirs = []
+    for dirpath, dirnames, _ in os.walk(root):
+        if 'sparse' in dirnames and os.path.isdir(os.path.join(dirpath, 'sparse', '0')):
+            sparse_dirs.append(Path(dirpath) / 'sparse' / '0')
+            # Prune only sparse/; sibling folders may hold nested reconstructions
+            dirnames.remove('sparse')
+    return sorted(sparse_dirs)
+
+def convert_task(task):
+    """Pool worker: returns (task, (n_imgs, n_pts), None) or (task, None, error)"""
+    sparse_dir, out_seq, img_src = task
+    # Only a directory this run creates may be cleaned up on failure
+    existed = os.path.exists(out_seq)
+    try:
+        return task, convert_sequence(sparse_dir, out_seq, img_src), None
+    except Exception as e:
+        # Don't leave a half-written sequence behind, but never delete earlier output
+        if not existed:
+            shutil.rmtree(out_seq, ignore_errors=True)
+        return task, None, str(e)
+
 def main():
     if len(sys.argv) != 4:
         print("Usage: python convert_with_separate_images.py <colmap_dir> <image_dir> <output_dir>")
@@ -251,7 +259,7 @@ def main():
 
     # Find all sparse/0 directories
     print("Scanning for COLMAP reconstructions...")
-    sparse_dirs = list(colmap_root.rglob('sparse/0'))
+    sparse_dirs = find_sparse_dirs(colmap_root)
 
     if not sparse_dirs:
         print(f"ERROR: No sparse/0 found in {colmap_root}")
@@ -262,35 +270,36 @@ def main():
     print(f"Images: {image_root}")
     print(f"Output: {output_root}\n")
 
-    bag_idx = 0
-    seq_idx = 0
+    # Map each COLMAP path to its image path and output bag_X/sequence_Y up front
+    tasks = []
+    log_labels = {}  # sparse_dir -> (sequence path relative to colmap_root, bag_X/seq_Y)
+    for i, sparse_dir in enumerate(sparse_dirs):
+        rel = sparse_dir.parent.parent.relative_to(colmap_root)
+        out_seq = output_root / f'bag_{i // 10}' / f'sequence_{i % 10}'
+        tasks.append((sparse_dir, out_seq, image_root / rel))
+        # The log has always used the short seq_Y form
+        log_labels[sparse_dir] = (rel, f'bag_{i // 10}/seq_{i % 10}')
+
+    # Create all bag_X directories once, before the workers start
+    for bag_idx in range((len(tasks) + 9) // 10):
+        (output_root / f'bag_{bag_idx}').mkdir(exist_ok=True)
+
     success = 0
     failed = 0
 
     log = output_root / 'conversion.log'
 
-    with open(log, 'w') as f:
+    with open(log, 'w') as f, Pool(os.cpu_count()) as pool:
         f.write(f"COLMAP: {colmap_root}\nImages: {image_root}\nOutput: {output_root}\n\n")
 
-        for sparse_dir in tqdm(sparse_dirs):
-            try:
-                # Map COLMAP path to image path
-                rel = sparse_dir.parent.parent.relative_to(colmap_root)
-                img_src = image_root / rel
-                out_seq = output_root / f'bag_{bag_idx}' / f'sequence_{seq_idx}'
-
-                n_imgs, n_pts = convert_sequence(sparse_dir, out_seq, img_src)
-
-                f.write(f"✓ {rel} -> bag_{bag_idx}/seq_{seq_idx} ({n_imgs} imgs, {n_pts} pts)\n")
+        for (sparse_dir, _, _), counts, error in tqdm(
+                pool.imap_unordered(convert_task, tasks), total=len(tasks)):
+            rel, seq_label = log_labels[sparse_dir]
+            if error is None:
+                f.write("✓ %s -> %s (%d imgs, %d pts)\n" % (rel, seq_label, *counts))
                 success += 1
-
-                seq_idx += 1
-                if seq_idx >= 10:
-                    seq_idx = 0
-                    bag_idx += 1
-
-            except Exception as e:
-                f.write(f"✗ {sparse_dir.relative_to(colmap_root)}: {e}\n")
+            else:
+                f.write("✗ %s/sparse/0: %s\n" % (rel, error))
                 failed += 1
 
     print(f"\n{'='*60}")
@@ -4,12 +4,22 @@ Extract multiple frames from spine endoscopy videos for COLMAP reconstruction
 Extracts frames at regular intervals to create temporal sequences
 """
 
+from collections import Counter
 import cv2
 import os
 import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
 from tqdm import tqdm
 
+# Frame gaps up to this size are skipped with grab() instead of a seek
+MAX_GRAB_GAP = 200
+
+VIDEO_EXTENSIONS = {'.mp4', '.avi'}
+
+# Baseline (non-optimized, non-progressive) JPEG: no extra entropy-coding pass
+JPEG_WRITE_PARAMS = [cv2.IMWRITE_JPEG_QUALITY, 95, cv2.IMWRITE_JPEG_OPTIMIZE, 0, cv2.IMWRITE_JPEG_PROGRESSIVE, 0]
+
 def extract_frames_from_video(video_path, output_dir, num_frames=8, start_sec=10, duration_sec=80):
     """
     Extract frames from video at regular intervals
@@ -53,20 +63,59 @@ def extract_frames_from_video(video_path, output_dir, num_frames=8, start_sec=10
     frame_indices = [int(start_frame + i * frame_interval) for i in range(num_frames)]
 
     extracted = 0
+    pos = 0  # Index of the frame the next grab() returns
     for idx, frame_num in enumerate(frame_indices):
-        cap.set(cv2.CAP_PROP_POS_FRAMES, frame_num)
-        ret, frame = cap.read()
+        # Seek only for long (or backward) jumps; set() goes back to the nearest
+        # keyframe and decodes forward, so short gaps are cheaper to grab() through
+        if frame_num < pos or frame_num - pos > MAX_GRAB_GAP:
+            cap.set(cv2.CAP_PROP_POS_FRAMES, frame_num)
+            pos = frame_num
+        while pos < frame_num and cap.grab():
+            pos += 1
+
+        ret = pos == frame_num and cap.grab()
+        if ret:
+            pos += 1
+            ret, frame = cap.retrieve()
 
         if ret:
             # Save with timestamp in filename for debugging
             timestamp = frame_num / fps if fps > 0 else frame_num
             output_file = output_path / f'frame_{idx:04d}_t{timestamp:.2f}.jpg'
-            cv2.imwrite(str(output_file), frame, [cv2.IMWRITE_JPEG_QUALITY, 95])
+            cv2.imwrite(str(output_file), frame, JPEG_WRITE_PARAMS)
             extracted += 1
 
     cap.release()
     return extracted, "Success"
 
+def output_dir_names(video_files, video_dir):
+    """
+    Output directory name for each video, unique across all of them
+
+    A video keeps its stem unless another video shares it; those are named after
+    their path relative to video_dir instead (sub/a.mp4 -> sub_a, or sub_a_mp4
+    when the same folder holds a.avi too). Videos that would still collide map
+    to None.
+    """
+    stem_counts = Counter(video_file.stem for video_file in video_files)
+    candidates = {}
+    for video_file in video_files:
+        if stem_counts[video_file.stem] == 1:
+            candidates[video_file] = video_file.stem
+        else:
+            rel = video_file.relative_to(video_dir)
+            candidates[video_file] = '_'.join(rel.parent.parts + (rel.stem,))
+
+    # Same folder, same stem, different extension
+    name_counts = Counter(candidates.values())
+    for video_file, name in candidates.items():
+        if name_counts[name] > 1:
+            candidates[video_file] = f'{name}_{video_file.suffix[1:]}'
+
+    name_counts = Counter(candidates.values())
+    return {video_file: name if name_counts[name] == 1 else None
+            for video_file, name in candidates.items()}
+
 def main():
     if len(sys.argv) < 3:
         print("Usage: python extract_video_frames.py <video_dir> <output_base_dir> [num_frames]")
@@ -93,11 +142,8 @@ def main():
 
     # Find all video files
     print("Scanning for video files...")
-    video_files = []
-    video_files.extend(list(video_dir.rglob('*.mp4')))
-    video_files.extend(list(video_dir.rglob('*.MP4')))
-    video_files.extend(list(video_dir.rglob('*.avi')))
-    video_files.extend(list(video_dir.rglob('*.AVI')))
+    # One walk for all extensions, matched case-insensitively
+    video_files = sorted(p for p in video_dir.rglob('*') if p.suffix.lower() in VIDEO_EXTENSIONS)
 
     if not video_files:
         print(f"ERROR: No video files found in {video_dir}")
@@ -117,28 +163,45 @@ def main():
         log.write(f"Output: {output_base}\n")
         log.write(f"Frames per video: {num_frames}\n\n")
 
-        for video_file in tqdm(video_files, desc="Extracting frames"):
-            # Create output directory based on video filename
-            video_name = video_file.stem
-            output_dir = output_base / video_name
-
-            # Extract frames
-            extracted, message = extract_frames_from_video(
-                video_file, output_dir,
-                num_frames=num_frames,
-                start_sec=10,  # Skip first 10 seconds (avoid unstable intro)
-                duration_sec=80  # Extract from 80-second window (10s spacing)
-            )
-
-            if extracted >= 8:  # Need at least 8 frames for COLMAP
-                log.write(f"✓ {video_name}: {extracted} frames\n")
-                success_count += 1
-            else:
-                log.write(f"✗ {video_name}: {message}\n")
-                failed_count += 1
-                # Remove empty directory
-                if output_dir.exists() and not any(output_dir.iterdir()):
-                    output_dir.rmdir()
+        # Videos are independent; OpenCV decoders are multithreaded themselves,
+        # so use half the cores
+        # Workers run concurrently, so no two videos may share an output directory
+        dir_names = output_dir_names(video_files, video_dir)
+
+        with ProcessPoolExecutor(max_workers=max(1, (os.cpu_count() or 2) // 2)) as executor:
+            futures = {}
+            for video_file in video_files:
+                # Create output directory based on video filename
+                if dir_names[video_file] is None:
+                    log.write(f"✗ {video_file.relative_to(video_dir)}: Output directory name collides with another video\n")
+                    failed_count += 1
+                    continue
+                output_dir = output_base / dir_names[video_file]
+
+                # Extract frames
+                future = executor.submit(
+                    extract_frames_from_video,
+                    video_file, output_dir,
+                    num_frames=num_frames,
+                    start_sec=10,  # Skip first 10 seconds (avoid unstable intro)
+                    duration_sec=80  # Extract from 80-second window (10s spacing)
+                )
+                futures[future] = output_dir
+
+            for future in tqdm(as_completed(futures), total=len(futures), desc="Extracting frames"):
+                output_dir = futures[future]
+                video_name = output_dir.name
+                extracted, message = future.result()
+
+                if extracted >= 8:  # Need at least 8 frames for COLMAP
+                    log.write(f"✓ {video_name}: {extracted} frames\n")
+                    success_count += 1
+                else:
+                    log.write(f"✗ {video_name}: {message}\n")
+                    failed_count += 1
+                    # Remove empty directory
+                    if output_dir.exists() and not any(output_dir.iterdir()):
+                        output_dir.rmdir()
 
     print()
     print("="*60)
@@ -7,57 +7,36 @@ Replaces them with device-agnostic code
 import re
 from pathlib import Path
 
+# (pattern, replacement) pairs; device must be available in the surrounding context
+CUDA_CALL_FIXES = [
+    # Fix specific patterns in _warp_coordinate_generate
+    (r'torch\.arange\(start=0, end=height, dtype=torch\.float32\)\.cuda\(\)',
+     'torch.arange(start=0, end=height, dtype=torch.float32, device=device)'),
+    (r'torch\.arange\(start=0, end=width, dtype=torch\.float32\)\.cuda\(\)',
+     'torch.arange(start=0, end=width, dtype=torch.float32, device=device)'),
+    (r'torch\.ones\(\(1, height, width, 1\), dtype=torch\.float32\)\.cuda\(\)',
+     'torch.ones((1, height, width, 1), dtype=torch.float32, device=device)'),
+    (r'torch\.eye\(3\)\.float\(\)\.cuda\(\)\.reshape',
+     'torch.eye(3, dtype=torch.float32, device=device).reshape'),
+    (r'torch\.tensor\(1\.0e30\)\.float\(\)\.cuda\(\)',
+     'torch.tensor(1.0e30, dtype=torch.float32, device=device)'),
+    (r'torch\.tensor\(1\.0\)\.float\(\)\.cuda\(\)',
+     'torch.tensor(1.0, dtype=torch.float32, device=device)'),
+    (r'torch\.tensor\(0\.0\)\.float\(\)\.cuda\(\)',
+     'torch.tensor(0.0, dtype=torch.float32, device=device)'),
+]
+
+# All patterns as one alternation, so the file is scanned in a single pass
+CUDA_CALL_PATTERN = re.compile('|'.join(f'(?P<p{i}>{pattern})' for i, (pattern, _) in enumerate(CUDA_CALL_FIXES)))
+
 def fix_models_cuda_calls(file_path):
     """Fix all .cuda() calls in models.py"""
 
     with open(file_path, 'r') as f:
         content = f.read()
 
-    # Pattern 1: torch.tensor(...).float().cuda() -> tensor with device
-    # We'll need to ensure device is available in context
-
-    # Fix specific patterns in _warp_coordinate_generate
-    content = re.sub(
-        r'torch\.arange\(start=0, end=height, dtype=torch\.float32\)\.cuda\(\)',
-        r'torch.arange(start=0, end=height, dtype=torch.float32, device=device)',
-        content
-    )
-
-    content = re.sub(
-        r'torch\.arange\(start=0, end=width, dtype=torch\.float32\)\.cuda\(\)',
-        r'torch.arange(start=0, end=width, dtype=torch.float32, device=device)',
-        content
-    )
-
-    content = re.sub(
-        r'torch\.ones\(\(1, height, width, 1\), dtype=torch\.float32\)\.cuda\(\)',
-        r'torch.ones((1, height, width, 1), dtype=torch.float32, device=device)',
-        content
-    )
-
-    content = re.sub(
-        r'torch\.eye\(3\)\.float\(\)\.cuda\(\)\.reshape',
-        r'torch.eye(3, dtype=torch.float32, device=device).reshape',
-        content
-    )
-
-    content = re.sub(
-        r'torch\.tensor\(1\.0e30\)\.float\(\)\.cuda\(\)',
-        r'torch.tensor(1.0e30, dtype=torch.float32, device=device)',
-        content
-    )
-
-    content = re.sub(
-        r'torch\.tensor\(1\.0\)\.float\(\)\.cuda\(\)',
-        r'torch.tensor(1.0, dtype=torch.float32, device=device)',
-        content
-    )
-
-    content = re.sub(
-        r'torch\.tensor\(0\.0\)\.float\(\)\.cuda\(\)',
-        r'torch.tensor(0.0, dtype=torch.float32, device=device)',
-        content
-    )
+    # Replace whichever pattern matched (group p<i> -> CUDA_CALL_FIXES[i])
+    content = CUDA_CALL_PATTERN.sub(lambda m: CUDA_CALL_FIXES[int(m.lastgroup[1:])][1], content)
 
     # Write back
     with open(file_path, 'w') as f:
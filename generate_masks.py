@@ -4,80 +4,161 @@ Generate undistorted_mask.bmp files for all sequences
 Creates white masks (all pixels valid) for COLMAP-converted data
 """
 
-import cv2
-import numpy as np
+import os
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
+from functools import lru_cache, partial
+import mmap
 from pathlib import Path
+from PIL import Image
+import struct
 import sys
 from tqdm import tqdm
 
-def create_mask_for_sequence(seq_dir):
+# Image files counted as views of a sequence (case-sensitive, as with glob)
+IMAGE_EXTENSIONS = ('.png', '.jpg')
+
+# Below this many sequences, masks are generated in-process
+MIN_SEQUENCES_FOR_POOL = 8
+
+# Points per write when emitting view_indexes_per_point
+POINTS_PER_WRITE = 1024
+
+# EXIF orientation tag; values 5-8 mean the stored image is rotated by 90 degrees
+EXIF_ORIENTATION_TAG = 0x0112
+
+# The structure.ply header is looked for within this many leading bytes
+PLY_HEADER_MAX_BYTES = 64 * 1024
+
+# 8-bit BMP grayscale palette: entry i is (B, G, R, reserved) = (i, i, i, 0)
+BMP_GRAYSCALE_PALETTE = b''.join(bytes((i, i, i, 0)) for i in range(256))
+
+@lru_cache(maxsize=8)
+def _get_mask_bmp(height, width):
+    """
+    All-white 8-bit grayscale BMP of the given size, as file bytes
+
+    Same bytes cv2.imwrite produces for a uint8 image of 255s: 14-byte file
+    header, 40-byte BITMAPINFOHEADER, 256-entry palette, bottom-up rows
+    padded to a multiple of 4 bytes
+    """
+    row_stride = (width + 3) & ~3
+    pixel_offset = 14 + 40 + len(BMP_GRAYSCALE_PALETTE)
+    file_size = pixel_offset + row_stride * height
+
+    file_header = struct.pack('<2sIHHI', b'BM', file_size, 0, 0, pixel_offset)
+    info_header = struct.pack('<IiiHHIIiiII', 40, width, height, 1, 8, 0, 0, 0, 0, 0, 0)
+    row = b'\xff' * width + b'\x00' * (row_stride - width)
+    return file_header + info_header + BMP_GRAYSCALE_PALETTE + row * height
+
+def _read_ply_vertex_count(ply_path):
+    """Vertex count from the PLY header; memory-mapped, so only the header pages are read"""
+    with open(ply_path, 'rb') as f:
+        # mmap cannot map an empty file
+        if os.fstat(f.fileno()).st_size == 0:
+            return 0
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            # Binary search for the tags: the PLY body may be binary_little_endian
+            end = mm.find(b'end_header', 0, PLY_HEADER_MAX_BYTES)
+            if end < 0:
+                end = min(len(mm), PLY_HEADER_MAX_BYTES)
+            idx = mm.find(b'element vertex ', 0, end)
+            if idx < 0:
+                return 0
+            line_end = mm.find(b'\n', idx)
+            if line_end < 0:
+                line_end = len(mm)
+            return int(mm[idx:line_end].split()[2])
+
+def create_mask_for_sequence(seq_dir, force=False):
     """Create mask and selected_indexes based on available images"""
     seq_path = Path(seq_dir)
+    mask_path = seq_path / 'undistorted_mask.bmp'
+    selected_indexes_path = seq_path / 'selected_indexes'
+    visible_view_indexes_path = seq_path / 'visible_view_indexes'
+    view_indexes_per_point_path = seq_path / 'view_indexes_per_point'
 
     # Find all images (directly in sequence directory, not in image_0 subdirectory)
-    images = sorted(list(seq_path.glob('*.png')) + list(seq_path.glob('*.jpg')))
+    # One scandir pass for both extensions
+    with os.scandir(seq_path) as entries:
+        image_entries = [entry for entry in entries
+                         if entry.name.endswith(IMAGE_EXTENSIONS) and entry.is_file()]
 
-    if not images:
+    if not image_entries:
         return False
 
-    # Read first image to get size
-    img = cv2.imread(str(images[0]))
-    if img is None:
-        return False
+    images = sorted(entry.name for entry in image_entries)
+    ply_path = seq_path / 'structure.ply'
 
-    height, width = img.shape[:2]
+    # Skip when an earlier run's outputs are at least as new as structure.ply and
+    # the newest image; a re-converted sequence rewrites those and is redone
+    if not force:
+        input_mtimes = [entry.stat().st_mtime for entry in image_entries]
+        if ply_path.exists():
+            input_mtimes.append(ply_path.stat().st_mtime)
+        try:
+            outputs_mtime = min(os.stat(path).st_mtime for path in (mask_path, selected_indexes_path,
+                                                                    visible_view_indexes_path,
+                                                                    view_indexes_per_point_path))
+            if outputs_mtime >= max(input_mtimes):
+                return True
+        except FileNotFoundError:
+            pass
+
+    # Get size of first image from its header, without decoding the pixels
+    try:
+        with Image.open(os.path.join(seq_path, images[0])) as img:
+            width, height = img.size
+            # PIL reports the stored size, but cv2.imread (and so the data loader)
+            # applies the EXIF orientation; byte-copied JPEGs can still carry it
+            if img.getexif().get(EXIF_ORIENTATION_TAG, 1) in (5, 6, 7, 8):
+                width, height = height, width
+    except OSError:
+        return False
 
-    # Create white mask (all pixels valid)
-    mask = np.ones((height, width), dtype=np.uint8) * 255
+    # Save white mask (all pixels valid), shared by all sequences of this resolution
+    mask_path.write_bytes(_get_mask_bmp(height, width))
 
-    # Save mask
-    mask_path = seq_path / 'undistorted_mask.bmp'
-    cv2.imwrite(str(mask_path), mask)
+    # One index per line: 0 .. len(images) - 1
+    view_indexes = ''.join(f'{i}\n' for i in range(len(images)))
 
     # Create selected_indexes file (sequential indices)
-    selected_indexes_path = seq_path / 'selected_indexes'
     with open(selected_indexes_path, 'w') as f:
-        for i in range(len(images)):
-            f.write(f'{i}\n')
+        f.write(view_indexes)
 
     # Create visible_view_indexes file (all views have visible points for COLMAP data)
-    visible_view_indexes_path = seq_path / 'visible_view_indexes'
     with open(visible_view_indexes_path, 'w') as f:
-        for i in range(len(images)):
-            f.write(f'{i}\n')
+        f.write(view_indexes)
 
     # Create view_indexes_per_point file
     # Format: -1 marks new point, then list view indices where it's visible
     # For COLMAP with few images, assume all points visible in all views
-    view_indexes_per_point_path = seq_path / 'view_indexes_per_point'
 
     # Count points from structure.ply
-    ply_path = seq_path / 'structure.ply'
-    num_points = 0
-    if ply_path.exists():
-        with open(ply_path, 'r') as f:
-            for line in f:
-                if line.startswith('element vertex'):
-                    num_points = int(line.split()[2])
-                    break
+    num_points = _read_ply_vertex_count(ply_path) if ply_path.exists() else 0
 
     # Write view_indexes_per_point
-    with open(view_indexes_per_point_path, 'w') as f:
-        for point_idx in range(num_points):
-            f.write('-1\n')  # Start new point
-            # Assume all points visible in all views (simple approximation)
-            for view_idx in range(len(images)):
-                f.write(f'{view_idx}\n')
+    # Assume all points visible in all views (simple approximation), so every
+    # point gets the same block: -1 (start new point) followed by all view indexes
+    point_block = '-1\n' + view_indexes
+    with open(view_indexes_per_point_path, 'w', buffering=1 << 20) as f:
+        # Whole chunks of points at a time, to bound the size of each string
+        for start in range(0, num_points, POINTS_PER_WRITE):
+            f.write(point_block * min(POINTS_PER_WRITE, num_points - start))
 
     return True
 
 def main():
-    if len(sys.argv) != 2:
-        print("Usage: python generate_masks.py <training_data_root>")
+    force = '--force' in sys.argv
+    args = [arg for arg in sys.argv[1:] if arg != '--force']
+
+    if len(args) != 1:
+        print("Usage: python generate_masks.py <training_data_root> [--force]")
+        print("  --force: Regenerate outputs for sequences that already have them")
         print("Example: python generate_masks.py /home/test1/workspace/training_data_formatted")
         sys.exit(1)
 
-    data_root = Path(sys.argv[1])
+    data_root = Path(args[0])
 
     if not data_root.exists():
         print(f"ERROR: Directory not found: {data_root}")
@@ -97,12 +178,23 @@ def main():
     success = 0
     failed = 0
 
-    for seq_dir in tqdm(sequences, desc="Creating masks"):
-        if create_mask_for_sequence(seq_dir):
-            success += 1
+    create_mask = partial(create_mask_for_sequence, force=force)
+
+    # Sequences are independent; a pool is only worth starting for more than a few.
+    # The pool's with block shuts it down even if a worker raises
+    with ExitStack() as stack:
+        if len(sequences) < MIN_SEQUENCES_FOR_POOL:
+            results = map(create_mask, sequences)
         else:
-            failed += 1
-            print(f"\nWarning: Failed to create mask for {seq_dir}")
+            executor = stack.enter_context(ProcessPoolExecutor(max_workers=os.cpu_count()))
+            results = executor.map(create_mask, sequences, chunksize=16)
+
+        for seq_dir, created in tqdm(zip(sequences, results), total=len(sequences), desc="Creating masks"):
+            if created:
+                success += 1
+            else:
+                failed += 1
+                print(f"\nWarning: Failed to create mask for {seq_dir}")
 
     print(f"\n{'='*60}")
     print("MASK GENERATION COMPLETE")
@@ -6,47 +6,132 @@ Applies contrast enhancement, sharpening, and denoising
 
 import cv2
 import numpy as np
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 import sys
 from tqdm import tqdm
 
-def enhance_for_colmap(image):
+# Image files picked up in each input directory (case-sensitive, as with glob)
+IMAGE_EXTENSIONS = ('.jpg', '.png')
+
+# 3x3 sharpening kernel (identity plus Laplacian)
+SHARPEN_KERNEL = np.array([[-1, -1, -1],
+                           [-1,  9, -1],
+                           [-1, -1, -1]], dtype=np.float32)
+
+# process_image outcomes
+PROCESSED = 'processed'
+SKIPPED = 'skipped'  # output already up to date
+FAILED = 'failed'
+
+# CLAHE objects are reused across images but are not safe to share between threads
+_thread_local = threading.local()
+
+def _get_clahe():
+    """This thread's CLAHE object, created on first use"""
+    clahe = getattr(_thread_local, 'clahe', None)
+    if clahe is None:
+        clahe = _thread_local.clahe = cv2.createCLAHE(clipLimit=3.0, tileGridSize=(8, 8))
+    return clahe
+
+def _scan_images(directory):
+    """Image files directly in directory, from a single scandir pass"""
+    with os.scandir(directory) as entries:
+        return [entry for entry in entries if entry.name.endswith(IMAGE_EXTENSIONS) and entry.is_file()]
+
+def _has_images(directory):
+    """True as soon as one image file is found directly in directory"""
+    with os.scandir(directory) as entries:
+        return any(entry.name.endswith(IMAGE_EXTENSIONS) and entry.is_file() for entry in entries)
+
+def enhance_for_colmap(image, clahe=None):
     """
     Enhance endoscopy image to make SIFT features more detectable
 
     Args:
         image: Input BGR image
+        clahe: Reusable cv2 CLAHE object (clipLimit=3.0, tileGridSize=(8, 8));
+               defaults to the calling thread's shared instance
 
     Returns:
         Enhanced BGR image
     """
     # Convert to LAB color space for better contrast adjustment
+    # (only L is processed; a and b stay in place in the LAB image)
     lab = cv2.cvtColor(image, cv2.COLOR_BGR2LAB)
-    l, a, b = cv2.split(lab)
+    l = cv2.extractChannel(lab, 0)
 
     # Apply CLAHE (Contrast Limited Adaptive Histogram Equalization) to L channel
-    clahe = cv2.createCLAHE(clipLimit=3.0, tileGridSize=(8, 8))
+    if clahe is None:
+        clahe = _get_clahe()
     l = clahe.apply(l)
 
-    # Merge back
-    enhanced_lab = cv2.merge([l, a, b])
-    enhanced = cv2.cvtColor(enhanced_lab, cv2.COLOR_LAB2BGR)
-
     # Apply bilateral filter to reduce noise while preserving edges
-    enhanced = cv2.bilateralFilter(enhanced, d=5, sigmaColor=50, sigmaSpace=50)
+    # (luminance only: chroma noise hardly matters for SIFT, which works on intensity).
+    # A 5-tap bilateral on one 8-bit channel is already cheap; edgePreservingFilter
+    # needs 3-channel input and is far slower, and guidedFilter needs opencv-contrib
+    l = cv2.bilateralFilter(l, d=5, sigmaColor=50, sigmaSpace=50)
 
-    # Sharpen to enhance edges (important for SIFT)
-    kernel = np.array([[-1, -1, -1],
-                       [-1,  9, -1],
-                       [-1, -1, -1]])
-    enhanced = cv2.filter2D(enhanced, -1, kernel)
+    # Write L back and convert once
+    cv2.insertChannel(l, lab, 0)
+    enhanced = cv2.cvtColor(lab, cv2.COLOR_LAB2BGR)
 
-    # Ensure values are in valid range
-    enhanced = np.clip(enhanced, 0, 255).astype(np.uint8)
+    # Sharpen to enhance edges (important for SIFT)
+    # Output depth -1 keeps uint8: filter2D already saturates to 0..255
+    enhanced = cv2.filter2D(enhanced, -1, SHARPEN_KERNEL)
 
     return enhanced
 
-def preprocess_directory(input_dir, output_dir, upscale=False):
+def process_image(img_file, output_dir, upscale=False, force=False):
+    """
+    Enhance one image and save it under output_dir with the same name
+
+    Args:
+        img_file: Path-like input image (os.DirEntry from _scan_images in practice)
+        output_dir: Output directory as a str
+
+    Returns:
+        PROCESSED if the image was written, SKIPPED if its output was already
+        up to date, FAILED if it could not be read or encoded
+    """
+    # Plain str paths for cv2 and os calls, no Path objects per image
+    img_path = os.fspath(img_file)
+    output_file = os.path.join(output_dir, os.path.basename(img_path))
+
+    # Skip images whose output is at least as new as the input, unless forced.
+    # An output that is the input file itself (output dir == input dir) never counts
+    if not force:
+        try:
+            output_stat, input_stat = os.stat(output_file), os.stat(img_path)
+            if not os.path.samestat(output_stat, input_stat) and output_stat.st_mtime >= input_stat.st_mtime:
+                return SKIPPED
+        except FileNotFoundError:
+            pass
+
+    # Read image
+    img = cv2.imread(img_path)
+    if img is None:
+        return FAILED
+
+    # Upscale if requested (helps with feature detection)
+    if upscale:
+        height, width = img.shape[:2]
+        img = cv2.resize(img, (width * 2, height * 2), interpolation=cv2.INTER_LINEAR)
+
+    # Enhance
+    enhanced = enhance_for_colmap(img)
+
+    # Save (encode in memory and write the buffer in one call)
+    ok, buf = cv2.imencode(os.path.splitext(output_file)[1], enhanced, [cv2.IMWRITE_JPEG_QUALITY, 95])
+    if not ok:
+        return FAILED
+    with open(output_file, 'wb') as f:
+        f.write(buf)
+    return PROCESSED
+
+def preprocess_directory(input_dir, output_dir, upscale=False, force=False):
     """
     Preprocess all images in a directory
 
@@ -54,48 +139,39 @@ def preprocess_directory(input_dir, output_dir, upscale=False):
         input_dir: Directory with original images
         output_dir: Where to save enhanced images
         upscale: If True, upscale images 2x for more features
+        force: If True, also redo images whose output is already up to date
+
+    Returns:
+        (processed, skipped) image counts
     """
     input_path = Path(input_dir)
     output_path = Path(output_dir)
     output_path.mkdir(parents=True, exist_ok=True)
 
     # Find all images
-    images = list(input_path.glob('*.jpg')) + list(input_path.glob('*.png'))
+    images = _scan_images(input_path)
 
     if not images:
-        return 0
-
-    processed = 0
-    for img_file in images:
-        # Read image
-        img = cv2.imread(str(img_file))
-        if img is None:
-            continue
-
-        # Upscale if requested (helps with feature detection)
-        if upscale:
-            height, width = img.shape[:2]
-            img = cv2.resize(img, (width * 2, height * 2), interpolation=cv2.INTER_CUBIC)
-
-        # Enhance
-        enhanced = enhance_for_colmap(img)
+        return 0, 0
 
-        # Save
-        output_file = output_path / img_file.name
-        cv2.imwrite(str(output_file), enhanced, [cv2.IMWRITE_JPEG_QUALITY, 95])
-        processed += 1
+    # cv2 releases the GIL in decode/filter/encode, so threads scale across cores
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        output_dir = os.fspath(output_path)
+        results = list(executor.map(lambda img_file: process_image(img_file, output_dir, upscale, force), images))
 
-    return processed
+    return results.count(PROCESSED), results.count(SKIPPED)
 
 def main():
     if len(sys.argv) < 3:
-        print("Usage: python preprocess_endoscopy_images.py <input_base_dir> <output_base_dir> [--upscale]")
+        print("Usage: python preprocess_endoscopy_images.py <input_base_dir> <output_base_dir> [--upscale] [--force]")
         print()
         print("This will enhance all images in subdirectories for better COLMAP reconstruction")
         print("Enhancements: CLAHE contrast, bilateral denoising, sharpening")
         print()
         print("Options:")
         print("  --upscale: Upscale images 2x (640x360 → 1280x720) for more features")
+        print("  --force: Reprocess images whose output is already newer than the input")
+        print("           (needed after changing --upscale)")
         print()
         print("Example:")
         print("  python preprocess_endoscopy_images.py \\")
@@ -107,6 +183,7 @@ def main():
     input_base = Path(sys.argv[1])
     output_base = Path(sys.argv[2])
     upscale = '--upscale' in sys.argv
+    force = '--force' in sys.argv
 
     if not input_base.exists():
         print(f"ERROR: Input directory not found: {input_base}")
@@ -124,13 +201,14 @@ def main():
     subdirs = []
     for item in input_base.iterdir():
         if item.is_dir():
-            if list(item.glob('*.jpg')) or list(item.glob('*.png')):
+            if _has_images(item):
                 subdirs.append(item)
 
     print(f"Found {len(subdirs)} directories with images")
     print()
 
     total_processed = 0
+    total_skipped = 0
     log_file = output_base / 'preprocessing_log.txt'
 
     with open(log_file, 'w') as log:
@@ -141,17 +219,23 @@ def main():
         for subdir in tqdm(subdirs, desc="Processing directories"):
             output_subdir = output_base / subdir.name
 
-            processed = preprocess_directory(subdir, output_subdir, upscale=upscale)
+            processed, skipped = preprocess_directory(subdir, output_subdir, upscale=upscale, force=force)
 
-            if processed > 0:
-                log.write(f"✓ {subdir.name}: {processed} images\n")
+            if processed > 0 or skipped > 0:
+                if skipped > 0:
+                    log.write(f"✓ {subdir.name}: {processed} images ({skipped} already up to date)\n")
+                else:
+                    log.write(f"✓ {subdir.name}: {processed} images\n")
                 total_processed += processed
+                total_skipped += skipped
             else:
                 log.write(f"✗ {subdir.name}: No images found\n")
 
     print()
     print("=== Enhancement Complete ===")
     print(f"Total images processed: {total_processed}")
+    if total_skipped > 0:
+        print(f"Skipped (already up to date): {total_skipped}")
     print(f"Log: {log_file}")
     print()
     print("Next step: Run COLMAP on enhanced images")